@@ -1,16 +1,30 @@
 import os
-import json
+import time
+import uuid
 import asyncio
+import heapq
+import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Set, Optional
+from typing import Dict, List, Optional, Set, Tuple, Union
 
+import msgspec
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.middleware.gzip import GZipMiddleware
 from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from redis import asyncio as aioredis
 
 
 app = FastAPI(title="Encrypted Chat API", version="1.2.0")
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger("chat")
 
 
 # =========================
@@ -19,9 +33,42 @@ app = FastAPI(title="Encrypted Chat API", version="1.2.0")
 ROOM_TTL_HOURS = int(os.getenv("ROOM_TTL_HOURS", "2"))  # 2 hours
 MESSAGE_TTL_SECONDS = ROOM_TTL_HOURS * 60 * 60
 SELF_DESTRUCT_SECONDS_DEFAULT = int(os.getenv("SELF_DESTRUCT_SECONDS", "60"))  # 1 minute
+SELF_DESTRUCT_TTL_GRACE_SECONDS = 60  # TTL backstop; the sweep normally deletes first
+ROOM_CLEANUP_INTERVAL_SECONDS = 300  # safety-net sweep for deadlines this worker never scheduled
+ROOM_TTL_GRACE_SECONDS = 2 * ROOM_CLEANUP_INTERVAL_SECONDS  # lets cleanup announce expiry before TTL deletes
+MESSAGE_WRITE_BATCH_MAX = 500  # docs per insert_many
+MESSAGE_DRAIN_TIMEOUT_SECONDS = 5  # how long shutdown waits for queued writes
+MESSAGES_BY_ROOM_INDEX = [("room_id", 1), ("timestamp", -1)]  # history + per-room deletes
+# Equality (active) before range (expires_at); room_id makes the cleanup query covered
+ROOMS_EXPIRY_INDEX = [("active", 1), ("expires_at", 1), ("room_id", 1)]
+OUTBOX_MAXSIZE = 32  # pending frames per client before it's checked for being stalled
+OUTBOX_HARD_MAXSIZE = 1024  # pending frames at which a client is dropped regardless
+SLOW_CLIENT_SECONDS = 5  # a single send blocked this long (with a backlog) marks a stalled client
+TYPING_FRAME_CACHE_SIZE = 256  # encoded typing frames kept per (username, isTyping)
+TYPING_REPEAT_INTERVAL_SECONDS = 0.2  # same isTyping state re-sent faster than this is dropped
+REACTION_DEDUP_SECONDS = 0.05  # identical reaction clicks within this window are dropped
+KNOWN_ROOMS_MAX = 10_000  # rooms whose DB doc we know is live, so rejoins skip Mongo
+DB_PING_INTERVAL_SECONDS = 1  # how often /health's cached Mongo status is refreshed
+DB_PING_TIMEOUT_SECONDS = 0.5
+GZIP_MIN_SIZE = 1024  # HTTP responses smaller than this (info, health) go out uncompressed
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "secure_chat")
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "200")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "20")),
+    "serverSelectionTimeoutMS": 5000,
+    "socketTimeoutMS": 10000,
+    "compressors": "zlib",  # stdlib; zstd/snappy need extra packages
+    "tz_aware": True,  # aware UTC datetimes, comparable with utc_now()
+}
+# Chat messages are short-lived (TTL) and re-sendable: ack from the primary only.
+# Room metadata keeps the default write concern.
+MESSAGE_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# Optional: set to share rooms across uvicorn workers/instances via Redis pub/sub
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_CHANNEL_PREFIX = "room:"
 
 # ✅ Parse allowed origins from env (comma-separated)
 # Example:
@@ -29,38 +76,46 @@ DB_NAME = os.getenv("DB_NAME", "secure_chat")
 env_origins = os.getenv("ALLOWED_ORIGINS", "")
 ALLOWED_ORIGINS = [o.strip() for o in env_origins.split(",") if o.strip()]
 
-# ✅ Add safe defaults (dev + Capacitor)
+# ✅ Add safe defaults (exact-match, O(1) lookup)
 DEFAULT_ORIGINS = [
     "https://chat-app-green-five-45.vercel.app",  # your Vercel
-    "https://localhost",  # Capacitor Android WebView origin (common)
-    "http://localhost",   # fallback
-    "http://localhost:5173",
-    "http://localhost:4173",
-    "http://127.0.0.1:5173",
-    "http://127.0.0.1:4173",
-    "http://localhost:3000",
 ]
 
-FINAL_ORIGINS = sorted(set(ALLOWED_ORIGINS + DEFAULT_ORIGINS))
+FINAL_ORIGINS = frozenset(ALLOWED_ORIGINS + DEFAULT_ORIGINS)
 
-print(f"🌍 ALLOWED_ORIGINS (final): {FINAL_ORIGINS}")
-print(f"🗄️ MongoDB: {MONGO_URI[:35]}..." if len(MONGO_URI) > 35 else MONGO_URI)
-print(f"🗄️ DB_NAME: {DB_NAME}")
+# ✅ Dev servers + Capacitor (https://localhost) on any port, matched by one
+# precompiled regex instead of listing every port
+ALLOWED_ORIGIN_REGEX = os.getenv(
+    "ALLOWED_ORIGIN_REGEX", r"https?://(localhost|127\.0\.0\.1)(:\d+)?"
+)
+
+logger.info(
+    "🌍 origins=%s origin_regex=%s 🗄️ mongo=%s db=%s",
+    sorted(FINAL_ORIGINS),
+    ALLOWED_ORIGIN_REGEX,
+    MONGO_URI[:35] + "..." if len(MONGO_URI) > 35 else MONGO_URI,
+    DB_NAME,
+)
 
 # ✅ CORS (must include Capacitor origin, otherwise APK fetch() fails)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=FINAL_ORIGINS,
+    allow_origin_regex=ALLOWED_ORIGIN_REGEX,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
     max_age=3600,
 )
 # FastAPI CORSMiddleware requires explicitly listing allowed origins when using credentials. [web:85]
+# Only large bodies (room history) are worth compressing; websocket frames are
+# sent uncompressed (see ws_per_message_deflate below).
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
 
 
 mongo_client: Optional[AsyncIOMotorClient] = None
 db = None
+redis_client: Optional[aioredis.Redis] = None
 
 
 def utc_now() -> datetime:
@@ -68,188 +123,568 @@ def utc_now() -> datetime:
 
 
 def utc_iso(dt: datetime) -> str:
+    if dt.tzinfo is timezone.utc:  # utc_now() values need no conversion
+        return dt.isoformat()
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(timezone.utc).isoformat()
 
 
+# =========================
+# WebSocket frames
+# =========================
+class Join(msgspec.Struct, tag="join"):
+    username: Optional[str] = None
+
+
+class UserLeaving(msgspec.Struct, tag="user_leaving"):
+    username: Optional[str] = None
+
+
+class Typing(msgspec.Struct, tag="typing"):
+    username: Optional[str] = None
+    isTyping: bool = False
+
+
+class Reaction(msgspec.Struct, tag="reaction"):
+    messageIndex: Optional[int] = None
+    emoji: Optional[str] = None
+    username: Optional[str] = None
+
+
+class ChatMessage(msgspec.Struct, tag="message"):
+    data: Optional[dict] = None
+    username: Optional[str] = None
+    selfDestruct: bool = False
+    destructTime: Optional[int] = None
+
+    def __post_init__(self):
+        # Raised inside decode() as msgspec.ValidationError (a DecodeError)
+        if not self.data or "encrypted" not in self.data or "iv" not in self.data:
+            raise ValueError("message data needs 'encrypted' and 'iv'")
+
+
+Inbound = Union[Join, UserLeaving, Typing, Reaction, ChatMessage]
+
+_inbound_decoder = msgspec.json.Decoder(Inbound)
+_frame_encoder = msgspec.json.Encoder()
+
+
+def encode_frame(message: dict) -> str:
+    # Text frame, since clients JSON.parse(event.data)
+    return _frame_encoder.encode(message).decode()
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_rooms: Dict[str, Set[WebSocket]] = {}
+        # room_id -> {id(ws): (ws, outbox)}, in join order
+        self.active_rooms: Dict[str, Dict[int, Tuple[WebSocket, asyncio.Queue]]] = {}
         self.room_created_at: Dict[str, datetime] = {}
-        self.user_names: Dict[WebSocket, str] = {}
-        self._self_destruct_tasks: Dict[str, asyncio.Task] = {}  # message_id -> Task
+        self._conns: Dict[int, Tuple[str, asyncio.Task]] = {}  # id(ws) -> (room_id, relay Task)
+        self._write_queue: asyncio.Queue = asyncio.Queue()  # message docs awaiting insert_many
+        self._bg_tasks: Set[asyncio.Task] = set()  # strong refs so pending tasks aren't GC'd
+        self._typing_frames: Dict[Tuple[str, bool], str] = {}  # insertion-ordered, oldest evicted
+        self._known_rooms: "OrderedDict[str, datetime]" = OrderedDict()  # room_id -> expires_at, LRU
+        self._expiry_heap: List[Tuple[datetime, str]] = []  # min-heap of (deadline, "room" | "message")
+        self._expiry_event = asyncio.Event()  # wakes the cleanup loop when a deadline is added
+        self.worker_id = uuid.uuid4().hex  # tags our Redis publishes so we skip our own echo
+        self._pubsub: Optional[aioredis.client.PubSub] = None
+        self._redis_listener: Optional[asyncio.Task] = None
+        self.db_status = "disconnected"  # refreshed by monitor_db(), read by /health
 
     async def connect(self, websocket: WebSocket, room_id: str):
         await websocket.accept()
 
         if room_id not in self.active_rooms:
-            self.active_rooms[room_id] = set()
-            self.room_created_at[room_id] = utc_now()
+            self.active_rooms[room_id] = {}
+            now = utc_now()
+            self.room_created_at[room_id] = now
 
-            if db:
+            if db is not None:
                 try:
-                    now = utc_now()
-                    await db.rooms.update_one(
-                        {"room_id": room_id},
-                        {"$set": {
-                            "room_id": room_id,
-                            "created_at": now,
-                            "expires_at": now + timedelta(hours=ROOM_TTL_HOURS),
-                            "active": True,
-                        }},
-                        upsert=True,
-                    )
-                except Exception as e:
-                    print(f"❌ Error creating room: {e}")
-
-        self.active_rooms[room_id].add(websocket)
-
-    def disconnect(self, websocket: WebSocket, room_id: str):
-        if room_id in self.active_rooms:
-            self.active_rooms[room_id].discard(websocket)
-
-            if websocket in self.user_names:
-                del self.user_names[websocket]
-
-            if len(self.active_rooms[room_id]) == 0:
-                del self.active_rooms[room_id]
-                self.room_created_at.pop(room_id, None)
+                    await self._ensure_room(room_id, now)
+                except Exception:
+                    logger.exception("❌ Error creating room")
+
+            await self._subscribe(room_id)
+
+        outbox: asyncio.Queue = asyncio.Queue()  # bounded by _is_stalled(), not maxsize
+        # Re-fetch: the room may have been closed while the awaits above ran
+        self.active_rooms.setdefault(room_id, {})[id(websocket)] = (websocket, outbox)
+        self._conns[id(websocket)] = (room_id, self.spawn(self._relay(websocket, outbox)))
+
+    async def _ensure_room(self, room_id: str, now: datetime):
+        expires_at = self._known_rooms.get(room_id)
+        if expires_at is not None and expires_at > now:
+            self._known_rooms.move_to_end(room_id)
+            return
+
+        fields = {
+            "room_id": room_id,
+            "created_at": now,
+            "expires_at": now + timedelta(hours=ROOM_TTL_HOURS),
+            "active": True,
+        }
+        try:
+            await db.rooms.insert_one(dict(fields))
+            expires_at = fields["expires_at"]
+        except DuplicateKeyError:
+            # Existing room: revive it if it already expired (whether or not a
+            # sweep has deactivated it yet), else keep its deadline
+            res = await db.rooms.update_one(
+                {"room_id": room_id, "$or": [{"active": False}, {"expires_at": {"$lte": now}}]},
+                {"$set": fields},
+            )
+            if res.modified_count:
+                expires_at = fields["expires_at"]
+            else:
+                room = await db.rooms.find_one({"room_id": room_id}, {"expires_at": 1, "_id": 0})
+                expires_at = room["expires_at"].replace(tzinfo=timezone.utc)
+
+        self._known_rooms[room_id] = expires_at
+        self._known_rooms.move_to_end(room_id)
+        if len(self._known_rooms) > KNOWN_ROOMS_MAX:
+            self._known_rooms.popitem(last=False)
+        self.schedule_expiry(expires_at, "room")
+
+    def disconnect(self, websocket: WebSocket):
+        # Idempotent: every path (client close, send error, slow client, room
+        # close) funnels through here and only the first call does anything
+        meta = self._conns.pop(id(websocket), None)
+        if meta is None:
+            return
+        room_id, relay = meta
+        if relay is not asyncio.current_task():
+            relay.cancel()
+
+        room = self.active_rooms.get(room_id)
+        if room is None:
+            return
+
+        # A closed room's members keep their _conns entry until their handler
+        # exits; by then room_id may name a new room this socket isn't in
+        if room.pop(id(websocket), None) is not None and not room:
+            del self.active_rooms[room_id]
+            self.room_created_at.pop(room_id, None)
+            if redis_client is not None:
+                self.spawn(self._unsubscribe(room_id))
 
     async def broadcast(self, message: dict, room_id: str, exclude: WebSocket = None):
-        if room_id not in self.active_rooms:
+        if room_id not in self.active_rooms and redis_client is None:
             return
+        # Serialize once for the whole room
+        await self.broadcast_frame(encode_frame(message), room_id, exclude)
+
+    async def broadcast_frame(self, payload: str, room_id: str, exclude: WebSocket = None):
+        # Other workers get the frame via Redis; our own members directly
+        await self._publish(room_id, "frame", payload)
+        await self._local_broadcast(payload, room_id, exclude)
+
+    async def close_room(self, room_id: str):
+        await self._publish(room_id, "close")
+        self._close_local_room(room_id)
+
+    async def _local_broadcast(self, payload: str, room_id: str, exclude: WebSocket = None):
+        # Hand an already-encoded frame to each client's relay; network I/O
+        # never happens here, so a stalled socket can't hold up the room.
+        room = self.active_rooms.get(room_id)
+        if not room:
+            return
+        targets = tuple(entry for entry in room.values() if entry[0] is not exclude)
 
-        disconnected = set()
-        for connection in self.active_rooms[room_id]:
-            if connection == exclude:
-                continue
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"❌ Error broadcasting: {e}")
-                disconnected.add(connection)
+        # Membership changes are applied only after the send phase
+        disconnected = []
+        for connection, outbox in targets:
+            outbox.put_nowait(payload)
+            if self._is_stalled(connection, outbox):
+                logger.warning("❌ Dropping slow client: %d frames pending", outbox.qsize())
+                disconnected.append(connection)
 
         for conn in disconnected:
-            self.disconnect(conn, room_id)
+            self.disconnect(conn)
+            self.spawn(self._close(conn, code=1013))
+
+    def typing_frame(self, username: str, is_typing: bool) -> str:
+        key = (username, is_typing)
+        payload = self._typing_frames.get(key)
+        if payload is None:
+            if len(self._typing_frames) >= TYPING_FRAME_CACHE_SIZE:
+                del self._typing_frames[next(iter(self._typing_frames))]
+            payload = self._typing_frames[key] = encode_frame(
+                {"type": "typing", "username": username, "isTyping": is_typing}
+            )
+        return payload
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+
+    async def stop_background_tasks(self):
+        tasks = list(self._bg_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def _is_stalled(websocket: WebSocket, outbox: asyncio.Queue) -> bool:
+        # A backlog alone isn't proof of a slow client: a producer that queues
+        # many frames without yielding fills every outbox before any relay
+        # runs. Only a relay stuck inside one send (or a runaway backlog) is.
+        backlog = outbox.qsize()
+        if backlog <= OUTBOX_MAXSIZE:
+            return False
+        if backlog >= OUTBOX_HARD_MAXSIZE:
+            return True
+        started = getattr(websocket.state, "send_started", None)
+        return started is not None and time.monotonic() - started > SLOW_CLIENT_SECONDS
+
+    async def _relay(self, websocket: WebSocket, outbox: asyncio.Queue):
+        try:
+            while True:
+                payload = await outbox.get()
+                if payload is None:  # close request, queued behind pending frames
+                    await websocket.close()
+                    return
+                websocket.state.send_started = time.monotonic()
+                await websocket.send_text(payload)
+                websocket.state.send_started = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("❌ Error broadcasting: %s", e)
+            self.disconnect(websocket)
+
+    def _close_local_room(self, room_id: str):
+        # Detach the room first, then close its sockets from the snapshot.
+        # Each relay closes its socket once pending frames are flushed; stalled
+        # sockets are closed in the background so a peer that never finishes
+        # the close handshake can't hold up the caller (Redis listener, sweep).
+        room = self.active_rooms.pop(room_id, None)
+        if room is None:
+            return
+        self.room_created_at.pop(room_id, None)
+        if redis_client is not None:
+            self.spawn(self._unsubscribe(room_id))
+
+        for conn, outbox in tuple(room.values()):
+            outbox.put_nowait(None)
+            if self._is_stalled(conn, outbox):
+                self.disconnect(conn)
+                self.spawn(self._close(conn))
+
+    # ---- Redis pub/sub (only when REDIS_URL is set) ----
+    # Each worker subscribes to room:{room_id} while it has local members.
+    # Messages are "<worker_id> <op> <payload>", op being "frame" or "close".
+
+    async def _publish(self, room_id: str, op: str, payload: str = ""):
+        if redis_client is None:
+            return
+        try:
+            await redis_client.publish(f"{REDIS_CHANNEL_PREFIX}{room_id}", f"{self.worker_id} {op} {payload}")
+        except Exception:
+            logger.exception("❌ Redis publish error")
+
+    async def _subscribe(self, room_id: str):
+        if redis_client is None:
+            return
+        if self._pubsub is None:
+            self._pubsub = redis_client.pubsub()
+        try:
+            await self._pubsub.subscribe(f"{REDIS_CHANNEL_PREFIX}{room_id}")
+        except Exception:
+            logger.exception("❌ Redis subscribe error")
+            return
+
+        # The listener exits once nothing is subscribed; restart it on demand
+        if self._redis_listener is None or self._redis_listener.done():
+            self._redis_listener = self.spawn(self._listen_redis())
+
+    async def _unsubscribe(self, room_id: str):
+        if room_id in self.active_rooms or self._pubsub is None:
+            return  # someone rejoined meanwhile
+        try:
+            await self._pubsub.unsubscribe(f"{REDIS_CHANNEL_PREFIX}{room_id}")
+        except Exception:
+            logger.exception("❌ Redis unsubscribe error")
+
+    async def _listen_redis(self):
+        while self._pubsub.subscribed:
+            try:
+                msg = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if msg is None:
+                    continue
+
+                worker_id, op, payload = msg["data"].split(" ", 2)
+                if worker_id == self.worker_id:
+                    continue
+
+                room_id = msg["channel"][len(REDIS_CHANNEL_PREFIX):]
+                if op == "close":
+                    self._close_local_room(room_id)
+                else:
+                    await self._local_broadcast(payload, room_id)
+            except Exception:
+                logger.exception("❌ Redis listener error")
+                await asyncio.sleep(1)
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int = 1000):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def save_message(self, message_doc: dict):
+        # Persisted by message_writer(); callers don't wait for the round-trip
+        self._write_queue.put_nowait(message_doc)
+        if "destructAt" in message_doc:
+            self.schedule_expiry(message_doc["destructAt"], "message")
+
+    async def message_writer(self):
+        # Group commit: whatever queued up while the previous insert_many was in
+        # flight goes out in the next one, so bursts share a round-trip and a
+        # lone message isn't delayed.
+        messages = db.get_collection("messages", write_concern=MESSAGE_WRITE_CONCERN)
+        while True:
+            batch: List[dict] = [await self._write_queue.get()]
+            while len(batch) < MESSAGE_WRITE_BATCH_MAX:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                await messages.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                first = errors[0].get("errmsg") if errors else e
+                logger.error("❌ Error saving %d of %d message(s): %s", len(errors), len(batch), first)
+            except Exception:
+                logger.exception("❌ Error saving %d message(s)", len(batch))
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    async def monitor_db(self):
+        # Keeps the Mongo ping off the /health request path. At most one ping
+        # is in flight: wait_for() would only abandon the Motor future while
+        # its executor thread kept blocking, so pings to a slow server would
+        # pile up in Motor's thread pool. A ping still pending after
+        # DB_PING_TIMEOUT_SECONDS flips the status without being abandoned.
+        while True:
+            ping = asyncio.ensure_future(db.command("ping"))
+            done, _ = await asyncio.wait({ping}, timeout=DB_PING_TIMEOUT_SECONDS)
+            if not done:
+                self.db_status = "disconnected"
+            try:
+                await ping
+                self.db_status = "connected"
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.db_status = "disconnected"
+            await asyncio.sleep(DB_PING_INTERVAL_SECONDS)
+
+    async def drain_message_writes(self):
+        try:
+            await asyncio.wait_for(self._write_queue.join(), MESSAGE_DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("❌ Shutdown with %d unsaved message(s)", self._write_queue.qsize())
+
+    def schedule_expiry(self, when: datetime, kind: str):
+        # Duplicates are harmless: a due entry just triggers a sweep that
+        # finds nothing left to expire
+        heapq.heappush(self._expiry_heap, (when, kind))
+        if self._expiry_heap[0][0] == when:
+            self._expiry_event.set()
 
     async def cleanup_old_rooms(self):
+        # Single loop for all expiry work. It sleeps until the earliest
+        # scheduled room/self-destruct deadline (or until an earlier one is
+        # added), so Mongo is only queried when something is actually due. A
+        # full sweep still runs every ROOM_CLEANUP_INTERVAL_SECONDS to catch
+        # deadlines set by other workers or before a restart.
+        loop = asyncio.get_running_loop()
+        next_full_sweep = loop.time() + ROOM_CLEANUP_INTERVAL_SECONDS
         while True:
             try:
-                await asyncio.sleep(300)
-                if not db:
+                self._expiry_event.clear()
+                timeout = next_full_sweep - loop.time()
+                if self._expiry_heap:
+                    timeout = min(timeout, (self._expiry_heap[0][0] - utc_now()).total_seconds())
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._expiry_event.wait(), timeout)
+                        continue  # new earliest deadline; recompute the timeout
+                    except asyncio.TimeoutError:
+                        pass
+
+                now = utc_now()
+                due: Set[str] = set()
+                while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                    due.add(heapq.heappop(self._expiry_heap)[1])
+                if loop.time() >= next_full_sweep:
+                    next_full_sweep = loop.time() + ROOM_CLEANUP_INTERVAL_SECONDS
+                    due.update(("room", "message"))
+                if db is None:
                     continue
 
-                current_time = utc_now()
-                expired_rooms = await db.rooms.find(
-                    {"expires_at": {"$lt": current_time}, "active": True}
-                ).to_list(length=200)
-
-                for room in expired_rooms:
-                    room_id = room["room_id"]
-                    print(f"🧹 Expiring room: {room_id}")
-
-                    await db.rooms.update_one(
-                        {"room_id": room_id},
-                        {"$set": {"active": False}},
-                    )
-
-                    res = await db.messages.delete_many({"room_id": room_id})
-                    print(f"   Deleted {res.deleted_count} messages")
-
-                    if room_id in self.active_rooms:
-                        await self.broadcast(
-                            {
-                                "type": "room_expired",
-                                "message": f"⏰ This room has expired after {ROOM_TTL_HOURS} hours",
-                                "timestamp": utc_iso(utc_now()),
-                            },
-                            room_id,
-                        )
-                        for conn in list(self.active_rooms[room_id]):
-                            try:
-                                await conn.close()
-                            except Exception:
-                                pass
-
-                        del self.active_rooms[room_id]
-                        self.room_created_at.pop(room_id, None)
-
-            except Exception as e:
-                print(f"❌ Cleanup task error: {e}")
-
-    async def schedule_self_destruct(self, message_id: str, room_id: str, seconds: int):
-        try:
-            await asyncio.sleep(max(1, int(seconds)))
+                if "message" in due:
+                    await self._expire_self_destructed()
+                if "room" in due:
+                    await self._expire_rooms()
+
+            except Exception:
+                logger.exception("❌ Cleanup task error")
+
+    async def _expire_rooms(self):
+        current_time = utc_now()
+        cursor = db.rooms.find(
+            {"expires_at": {"$lt": current_time}, "active": True},
+            projection={"room_id": 1, "_id": 0},
+        ).hint(ROOMS_EXPIRY_INDEX).batch_size(200)
+        expired_ids = [room["room_id"] async for room in cursor]
+        if not expired_ids:
+            return
 
-            if not db:
-                return
+        # One round-trip per collection for the whole batch
+        await db.rooms.update_many(
+            {"room_id": {"$in": expired_ids}},
+            {"$set": {"active": False}},
+        )
+        res = await db.messages.delete_many(
+            {"room_id": {"$in": expired_ids}},
+            hint=MESSAGES_BY_ROOM_INDEX,  # room_id prefix; never a collection scan
+        )
+        logger.info("🧹 Expired %d room(s), deleted %d messages", len(expired_ids), res.deleted_count)
+
+        for room_id in expired_ids:
+            await self.broadcast(
+                {
+                    "type": "room_expired",
+                    "message": f"⏰ This room has expired after {ROOM_TTL_HOURS} hours",
+                    "timestamp": current_time,
+                },
+                room_id,
+            )
+            await self.close_room(room_id)
+
+    async def _expire_self_destructed(self):
+        now = utc_now()
+        cursor = db.messages.find(
+            {"destructAt": {"$lte": now}},
+            projection={"room_id": 1},
+        ).batch_size(500)
+        due = [msg async for msg in cursor]
+        if not due:
+            return
 
-            # ✅ _id is ObjectId in Mongo, convert from string
-            res = await db.messages.delete_one({"_id": ObjectId(message_id)})
-            if res.deleted_count:
-                await self.broadcast(
-                    {
-                        "type": "message_deleted",
-                        "message_id": message_id,
-                        "room_id": room_id,
-                        "timestamp": utc_iso(utc_now()),
-                    },
-                    room_id,
-                )
-        except Exception as e:
-            print(f"❌ Self-destruct task error: {e}")
-        finally:
-            self._self_destruct_tasks.pop(message_id, None)
+        await db.messages.delete_many({"_id": {"$in": [msg["_id"] for msg in due]}})
+
+        # One frame per room, however many of its messages came due together
+        by_room: Dict[str, List[str]] = {}
+        for msg in due:
+            by_room.setdefault(msg["room_id"], []).append(str(msg["_id"]))
+        for room_id, message_ids in by_room.items():
+            await self.broadcast(
+                {
+                    "type": "message_deleted",
+                    "message_ids": message_ids,
+                    "room_id": room_id,
+                    "timestamp": now,
+                },
+                room_id,
+            )
 
 
 manager = ConnectionManager()
 
 
+async def ensure_ttl_index(collection, field: str, expire_after: int, **kwargs):
+    # create_index() can't change options on an existing index, so drop a
+    # same-key index with a different (or no) TTL and recreate it
+    existing_indexes = await collection.index_information()
+    for name, info in existing_indexes.items():
+        if info.get("key") == [(field, 1)]:
+            old = info.get("expireAfterSeconds")
+            if old == expire_after:
+                return
+            logger.info(
+                "🛠️ Updating TTL index %s.%s: %s -> %ss (drop+recreate)", collection.name, name, old, expire_after
+            )
+            await collection.drop_index(name)
+            break
+    await collection.create_index(field, expireAfterSeconds=expire_after, **kwargs)
+
+
+async def _create_indexes(db):
+    # Idempotent; safe to re-run after the collections are dropped
+    await db.rooms.create_index("room_id", unique=True)
+    # Rooms are deleted once past expiry + grace; cleanup_old_rooms() still
+    # announces the expiry and purges messages first
+    await ensure_ttl_index(db.rooms, "expires_at", ROOM_TTL_GRACE_SECONDS)
+    await db.rooms.create_index(ROOMS_EXPIRY_INDEX)
+    if "active_1_expires_at_1" in await db.rooms.index_information():
+        await db.rooms.drop_index("active_1_expires_at_1")  # prefix of ROOMS_EXPIRY_INDEX
+    await db.messages.create_index(MESSAGES_BY_ROOM_INDEX)
+
+    # Self-destruct: cleanup_old_rooms() deletes and announces messages as
+    # they come due; this TTL index only catches what a crashed or
+    # restarting worker missed (Mongo's TTL monitor runs every ~60s).
+    await ensure_ttl_index(
+        db.messages,
+        "destructAt",
+        SELF_DESTRUCT_TTL_GRACE_SECONDS,
+        partialFilterExpression={"destructAt": {"$exists": True}},
+    )
+
+    # TTL for messages (2h)
+    await ensure_ttl_index(db.messages, "timestamp", MESSAGE_TTL_SECONDS)
+
+
 @app.on_event("startup")
 async def startup_event():
-    global mongo_client, db
+    global mongo_client, db, redis_client
     try:
-        mongo_client = AsyncIOMotorClient(MONGO_URI)
+        mongo_client = AsyncIOMotorClient(MONGO_URI, **MONGO_CLIENT_OPTIONS)
         db = mongo_client[DB_NAME]
+        manager.spawn(manager.message_writer())
+        manager.spawn(manager.monitor_db())
 
         await db.command("ping")
-        print("✅ Connected to MongoDB")
-
-        await db.rooms.create_index("room_id", unique=True)
-        await db.rooms.create_index("expires_at")
-        await db.rooms.create_index([("active", 1), ("expires_at", 1)])
-        await db.messages.create_index([("room_id", 1), ("timestamp", -1)])
-
-        # TTL for messages (2h)
-        existing_indexes = await db.messages.index_information()
-        ttl_index_name = None
-        for name, info in existing_indexes.items():
-            if info.get("key") == [("timestamp", 1)] and "expireAfterSeconds" in info:
-                ttl_index_name = name
-                break
-
-        if ttl_index_name:
-            old = existing_indexes[ttl_index_name].get("expireAfterSeconds")
-            if old != MESSAGE_TTL_SECONDS:
-                print(f"🛠️ Updating TTL index {old}s -> {MESSAGE_TTL_SECONDS}s (drop+recreate)")
-                await db.messages.drop_index(ttl_index_name)
-                await db.messages.create_index("timestamp", expireAfterSeconds=MESSAGE_TTL_SECONDS)
-        else:
-            await db.messages.create_index("timestamp", expireAfterSeconds=MESSAGE_TTL_SECONDS)
-
-        asyncio.create_task(manager.cleanup_old_rooms())
-        print("✅ Background cleanup task started")
+        logger.info("✅ Connected to MongoDB")
 
-    except Exception as e:
-        print(f"❌ Startup error: {e}")
+        await _create_indexes(db)
+
+        manager.spawn(manager.cleanup_old_rooms())
+        logger.info("✅ Background cleanup task started")
+
+    except Exception:
+        logger.exception("❌ Startup error")
+
+    if REDIS_URL:
+        try:
+            client = aioredis.from_url(REDIS_URL, decode_responses=True)
+            await client.ping()
+            redis_client = client
+            logger.info("✅ Connected to Redis (cross-worker fan-out enabled)")
+        except Exception:
+            logger.exception("❌ Redis connection error")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    if mongo_client:
+    if db is not None:
+        await manager.drain_message_writes()
+    await manager.stop_background_tasks()
+    if redis_client is not None:
+        await redis_client.aclose()
+        logger.info("✅ Redis connection closed")
+    if mongo_client is not None:
         mongo_client.close()
-        print("✅ MongoDB connection closed")
+        logger.info("✅ MongoDB connection closed")
 
 
 @app.get("/")
@@ -265,17 +700,9 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    db_status = "disconnected"
-    try:
-        if db:
-            await db.command("ping")
-            db_status = "connected"
-    except Exception:
-        pass
-
     return {
         "status": "healthy",
-        "database": db_status,
+        "database": manager.db_status,
         "active_rooms": len(manager.active_rooms),
         "timestamp": utc_iso(utc_now()),
     }
@@ -284,13 +711,17 @@ async def health_check():
 @app.get("/room/{room_id}/info")
 async def get_room_info(room_id: str):
     try:
-        if not db:
+        if db is None:
             return {"exists": False, "error": "DB not ready"}
 
-        room = await db.rooms.find_one({"room_id": room_id, "active": True})
+        room = await db.rooms.find_one(
+            {"room_id": room_id, "active": True},
+            {"created_at": 1, "expires_at": 1, "_id": 0},
+        )
         if room:
-            if room["expires_at"] < utc_now():
-                await db.rooms.update_one({"room_id": room_id}, {"$set": {"active": False}})
+            # Expired rooms are deactivated by cleanup and removed by TTL; no write here
+            now = utc_now()
+            if room["expires_at"] < now:
                 return {"exists": False, "room_id": room_id}
 
             return {
@@ -298,44 +729,49 @@ async def get_room_info(room_id: str):
                 "room_id": room_id,
                 "created_at": utc_iso(room["created_at"]),
                 "expires_at": utc_iso(room["expires_at"]),
-                "active_users": len(manager.active_rooms.get(room_id, set())),
-                "time_remaining": str(room["expires_at"] - utc_now()),
+                "active_users": len(manager.active_rooms.get(room_id, {})),
+                "time_remaining": str(room["expires_at"] - now),
             }
 
         return {"exists": False, "room_id": room_id}
     except Exception as e:
-        print(f"❌ Error fetching room info: {e}")
+        logger.exception("❌ Error fetching room info")
         return {"exists": False, "error": str(e)}
 
 
 @app.get("/room/{room_id}/history")
 async def get_room_history(room_id: str):
     try:
-        if not db:
+        if db is None:
             return {"messages": [], "error": "DB not ready"}
 
-        room = await db.rooms.find_one({"room_id": room_id, "active": True})
+        room = await db.rooms.find_one({"room_id": room_id, "active": True}, {"_id": 1})
         if not room:
             return {"messages": []}
 
-        messages = await db.messages.find({"room_id": room_id}).sort("timestamp", 1).limit(100).to_list(length=100)
+        # Walk the (room_id, timestamp desc) index natively for the latest 100,
+        # then flip to chronological order in memory. _id stays in the
+        # projection because it's returned as the message id.
+        cursor = db.messages.find(
+            {"room_id": room_id, "encrypted_data": {"$exists": True, "$ne": {}}},
+            projection={"username": 1, "encrypted_data": 1, "timestamp": 1, "selfDestruct": 1, "destructTime": 1},
+        ).sort("timestamp", -1).limit(100)
+        messages = [
+            {
+                "id": str(msg["_id"]),
+                "username": msg.get("username", "Anonymous"),
+                "encrypted_data": msg["encrypted_data"],
+                "timestamp": utc_iso(msg["timestamp"]),
+                "selfDestruct": msg.get("selfDestruct", False),
+                "destructTime": msg.get("destructTime"),
+            }
+            async for msg in cursor
+        ]
+        messages.reverse()
 
-        return {
-            "messages": [
-                {
-                    "id": str(msg.get("_id")),
-                    "username": msg.get("username", "Anonymous"),
-                    "encrypted_data": msg.get("encrypted_data", {}),
-                    "timestamp": utc_iso(msg["timestamp"]),
-                    "selfDestruct": msg.get("selfDestruct", False),
-                    "destructTime": msg.get("destructTime"),
-                }
-                for msg in messages
-                if "encrypted_data" in msg and msg["encrypted_data"]
-            ]
-        }
+        return {"messages": messages}
     except Exception as e:
-        print(f"❌ Error fetching history: {e}")
+        logger.exception("❌ Error fetching history")
         return {"messages": [], "error": str(e)}
 
 
@@ -347,130 +783,149 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
     try:
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
-            message_type = message_data.get("type")
+            try:
+                frame = _inbound_decoder.decode(data)
+            except msgspec.DecodeError:
+                continue  # malformed frame or unknown type
+            now = utc_now()
 
-            if message_type == "join":
-                current_username = message_data.get("username", "Anonymous")
-                manager.user_names[websocket] = current_username
+            if isinstance(frame, Join):
+                current_username = frame.username or "Anonymous"
+                websocket.state.left_announced = False
 
                 await manager.broadcast(
                     {
                         "type": "user_joined",
                         "username": current_username,
                         "message": f"👋 {current_username} joined the room",
-                        "timestamp": utc_iso(utc_now()),
+                        "timestamp": now,
                     },
                     room_id,
                 )
 
-            elif message_type == "user_leaving":
-                username = message_data.get("username", current_username)
+            elif isinstance(frame, UserLeaving):
+                username = frame.username or current_username
                 await manager.broadcast(
                     {
                         "type": "user_left",
                         "username": username,
                         "message": f"👋 {username} left the room",
-                        "timestamp": utc_iso(utc_now()),
+                        "timestamp": now,
                     },
                     room_id,
                 )
+                websocket.state.left_announced = True  # the close that follows needn't repeat it
 
-            elif message_type == "typing":
-                await manager.broadcast(
-                    {
-                        "type": "typing",
-                        "username": message_data.get("username", current_username),
-                        "isTyping": message_data.get("isTyping", False),
-                    },
+            elif isinstance(frame, Typing):
+                # Per-socket coalescing: state changes always go out, repeats at most 5/s
+                mono = time.monotonic()
+                last_state, last_at = getattr(websocket.state, "last_typing", (None, 0.0))
+                if last_state == frame.isTyping and mono - last_at < TYPING_REPEAT_INTERVAL_SECONDS:
+                    continue
+                websocket.state.last_typing = (frame.isTyping, mono)
+
+                await manager.broadcast_frame(
+                    manager.typing_frame(frame.username or current_username, frame.isTyping),
                     room_id,
                     exclude=websocket,
                 )
 
-            elif message_type == "reaction":
+            elif isinstance(frame, Reaction):
+                username = frame.username or current_username
+                mono = time.monotonic()
+                key = (frame.messageIndex, frame.emoji, username)
+                last_key, last_at = getattr(websocket.state, "last_reaction", (None, 0.0))
+                if last_key == key and mono - last_at < REACTION_DEDUP_SECONDS:
+                    continue  # double click
+                websocket.state.last_reaction = (key, mono)
+
                 await manager.broadcast(
                     {
                         "type": "reaction",
-                        "messageIndex": message_data.get("messageIndex"),
-                        "emoji": message_data.get("emoji"),
-                        "username": message_data.get("username", current_username),
+                        "messageIndex": frame.messageIndex,
+                        "emoji": frame.emoji,
+                        "username": username,
                     },
                     room_id,
                 )
 
-            elif message_type == "message":
-                encrypted_data = message_data.get("data", {})
-                if not encrypted_data or not isinstance(encrypted_data, dict):
-                    continue
-                if "encrypted" not in encrypted_data or "iv" not in encrypted_data:
-                    continue
-
-                now = utc_now()
-
-                self_destruct = bool(message_data.get("selfDestruct", False))
-                destruct_time = message_data.get("destructTime")
+            elif isinstance(frame, ChatMessage):
+                encrypted_data = frame.data
+                self_destruct = frame.selfDestruct
+                username = frame.username or current_username
 
                 if self_destruct:
-                    seconds = int(destruct_time) if destruct_time else SELF_DESTRUCT_SECONDS_DEFAULT
+                    seconds = frame.destructTime or SELF_DESTRUCT_SECONDS_DEFAULT
                     seconds = max(5, min(seconds, 600))
-                    destruct_at = now + timedelta(seconds=seconds)
                 else:
                     seconds = None
-                    destruct_at = None
 
+                # _id is assigned here so the broadcast doesn't wait on Mongo
                 message_doc = {
+                    "_id": ObjectId(),
                     "room_id": room_id,
-                    "username": message_data.get("username", current_username),
+                    "username": username,
                     "encrypted_data": encrypted_data,
                     "timestamp": now,
                     "selfDestruct": self_destruct,
                     "destructTime": seconds,
-                    "destructAt": destruct_at,
                 }
+                if self_destruct:
+                    # Only self-destruct docs carry destructAt (partial TTL index)
+                    message_doc["destructAt"] = now + timedelta(seconds=seconds)
 
-                inserted_id = None
-                if db:
-                    try:
-                        res = await db.messages.insert_one(message_doc)
-                        inserted_id = str(res.inserted_id)
-                    except Exception as e:
-                        print(f"❌ Error saving message: {e}")
+                message_id = None
+                if db is not None:
+                    manager.save_message(message_doc)
+                    message_id = str(message_doc["_id"])
 
                 await manager.broadcast(
                     {
                         "type": "message",
                         "data": encrypted_data,
-                        "username": message_data.get("username", current_username),
-                        "timestamp": utc_iso(now),
+                        "username": username,
+                        "timestamp": now,
                         "selfDestruct": self_destruct,
                         "destructTime": seconds,
-                        "message_id": inserted_id,
+                        "message_id": message_id,
                     },
                     room_id,
                 )
 
-                if self_destruct and inserted_id:
-                    t = asyncio.create_task(manager.schedule_self_destruct(inserted_id, room_id, seconds))
-                    manager._self_destruct_tasks[inserted_id] = t
-
     except WebSocketDisconnect:
-        manager.disconnect(websocket, room_id)
-        if current_username != "Anonymous":
+        manager.disconnect(websocket)
+        if current_username != "Anonymous" and not getattr(websocket.state, "left_announced", False):
             await manager.broadcast(
                 {
                     "type": "user_left",
                     "username": current_username,
                     "message": f"👋 {current_username} left the room",
-                    "timestamp": utc_iso(utc_now()),
+                    "timestamp": utc_now(),
                 },
                 room_id,
             )
-    except Exception as e:
-        print(f"❌ WebSocket error: {e}")
-        manager.disconnect(websocket, room_id)
+    except Exception:
+        logger.exception("❌ WebSocket error")
+    finally:
+        # Also covers cancellation (server shutdown) and any path that skipped
+        # the handlers above; disconnect() is a no-op if already done
+        manager.disconnect(websocket)
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info", access_log=True)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        log_level="warning",
+        access_log=False,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        # Frames are tiny (typing, reactions) or ciphertext that deflates by
+        # ~20%, and ASGI can't toggle compression per frame
+        ws_per_message_deflate=False,
+        ws_max_size=1024 * 1024,
+    )